@@ -1,29 +1,111 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Header, Query, Request
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
+import asyncio
+import codecs
+import csv
+import io
+import hashlib
+import hmac
+import ipaddress
+import json
 import logging
+import math
+import re
+import time
+from contextlib import asynccontextmanager
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
 import uuid
+from collections import OrderedDict
 from datetime import datetime, timezone
 from emergentintegrations.llm.chat import LlmChat, UserMessage
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# MongoDB connection (opened in the app lifespan)
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+mongo_settings = {
+    "maxPoolSize": int(os.environ.get('MONGO_MAX_POOL_SIZE', '100')),
+    "minPoolSize": int(os.environ.get('MONGO_MIN_POOL_SIZE', '10')),
+    "maxIdleTimeMS": int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '300000')),
+    "connectTimeoutMS": int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '5000')),
+    "serverSelectionTimeoutMS": int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000')),
+    "waitQueueTimeoutMS": int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '5000')),
+}
+client: Optional[AsyncIOMotorClient] = None
+db = None
+
+# Readiness: set once warmup has connected, seeded and primed caches
+app_ready = False
+warmup_retry_seconds = float(os.environ.get('WARMUP_RETRY_SECONDS', '5'))
+readiness_timeout_seconds = float(os.environ.get('READINESS_TIMEOUT_SECONDS', '2'))
+
+# Read-mostly catalogs (doctors, medicines, emergency contacts) are cached in-process
+catalog_cache_seconds = float(os.environ.get('CATALOG_CACHE_SECONDS', '60'))
+catalog_cache: Dict[str, Tuple[float, list]] = {}
 
 # LLM Chat setup
 emergent_llm_key = os.environ.get('EMERGENT_LLM_KEY')
 
+# Background health planner workers
+planner_worker_count = int(os.environ.get('PLANNER_WORKERS', '4'))
+planner_poll_seconds = float(os.environ.get('PLANNER_POLL_SECONDS', '2'))
+# A running job whose lease has lapsed is assumed orphaned and may be claimed again
+planner_lease_seconds = float(os.environ.get('PLANNER_LEASE_SECONDS', '300'))
+planner_job_wakeup = asyncio.Event()
+planner_workers: List[asyncio.Task] = []
+
+# Rate limiting: "METHOD /path=capacity/seconds" entries, comma separated
+default_rate_limits = (
+    "POST /api/chat/dadi=20/60,"
+    "POST /api/symptoms/analyze=10/60,"
+    "POST /api/disease/report=30/60,"
+    "POST /api/doctors/book=10/60"
+)
+rate_limit_backend = os.environ.get('RATE_LIMIT_BACKEND', 'memory')  # 'memory' or 'mongo'
+# Each client IP also gets its own bucket, this many times larger (one IP may serve many users)
+# Set it to 0 to limit callers that send a user_id by user only
+rate_limit_ip_multiplier = float(os.environ.get('RATE_LIMIT_IP_MULTIPLIER', '5'))
+# Comma-separated proxy IPs/CIDRs (e.g. the ingress) whose X-Forwarded-For is trusted for the client IP
+rate_limit_trusted_proxies = [
+    ipaddress.ip_network(entry.strip(), strict=False)
+    for entry in os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', '').split(',')
+    if entry.strip()
+]
+
+# Idempotency keys: cached responses are kept this long, in-flight claims much shorter
+idempotency_ttl_seconds = int(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24')) * 3600
+idempotency_lock_seconds = 60
+
+# Admin bulk import/export (disabled unless ADMIN_API_KEY is set)
+admin_api_key = os.environ.get('ADMIN_API_KEY')
+bulk_batch_size = int(os.environ.get('BULK_BATCH_SIZE', '1000'))
+bulk_max_reported_errors = 1000
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client, db, app_ready
+    client = AsyncIOMotorClient(mongo_url, **mongo_settings)
+    db = client[os.environ['DB_NAME']]
+    warmup_task = asyncio.create_task(warmup())
+    yield
+    app_ready = False
+    warmup_task.cancel()
+    await asyncio.gather(warmup_task, return_exceptions=True)
+    await stop_planner_workers()
+    client.close()
+
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -110,6 +192,19 @@ class DiseaseAlert(BaseModel):
     prevention_tips: str
     date_reported: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class PlannerJob(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    request_hash: str
+    user_id: str
+    request: Dict[str, Any]
+    status: str = "queued"  # 'queued', 'running', 'completed', 'failed'
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    attempts: int = 0
+    lease_until: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
 # Mock Data Creation Functions
 async def create_mock_doctors():
     mock_doctors = [
@@ -257,18 +352,128 @@ async def create_mock_emergency_contacts():
             contact = EmergencyContact(**contact_data)
             await db.emergency_contacts.insert_one(contact.dict())
 
-# Initialize mock data on startup
-@app.on_event("startup")
-async def startup_event():
-    await create_mock_doctors()
-    await create_mock_medicines()
-    await create_mock_emergency_contacts()
+# Warmup: runs in the background so liveness answers while the worker gets ready
+async def warmup():
+    global app_ready
+    while True:
+        try:
+            # Open the minimum pool up front instead of on the first requests
+            await asyncio.gather(*(client.admin.command("ping") for _ in range(max(1, mongo_settings["minPoolSize"]))))
+            await create_mock_doctors()
+            await create_mock_medicines()
+            await create_mock_emergency_contacts()
+            await create_idempotency_indexes()
+            await prime_catalog_cache()
+            await start_planner_workers()
+            break
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Warmup failed, retrying in %.0fs", warmup_retry_seconds)
+            await asyncio.sleep(warmup_retry_seconds)
+    app_ready = True
+    logger.info("Warmup complete, worker is ready")
+
+# Catalog cache
+async def get_catalog(collection: str, model) -> list:
+    cached = catalog_cache.get(collection)
+    if cached and time.monotonic() - cached[0] < catalog_cache_seconds:
+        return cached[1]
+    documents = await db[collection].find().to_list(1000)
+    items = [model(**document) for document in documents]
+    catalog_cache[collection] = (time.monotonic(), items)
+    return items
+
+async def prime_catalog_cache():
+    await get_catalog("doctors", Doctor)
+    await get_catalog("medicines", Medicine)
+    await get_catalog("emergency_contacts", EmergencyContact)
+
+# Idempotency keys
+async def create_idempotency_indexes():
+    await db.idempotency_keys.create_index("expires_at", expireAfterSeconds=0)
+
+def expired(expires_at: datetime, now: datetime) -> bool:
+    # Motor returns naive datetimes that are in UTC
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    return expires_at <= now
+
+async def run_idempotent(
+    scope: str,
+    key: Optional[str],
+    payload: Any,
+    handler: Callable[[], Awaitable[Any]],
+) -> Any:
+    """Run ``handler`` once per Idempotency-Key and replay its response on retries."""
+    if not key:
+        return await handler()
+
+    record_id = f"{scope}:{key}"
+    request_hash = hashlib.sha256(
+        json.dumps(jsonable_encoder(payload), sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    now = datetime.now(timezone.utc)
+    try:
+        await db.idempotency_keys.insert_one({
+            "_id": record_id,
+            "request_hash": request_hash,
+            "status": "in_progress",
+            "created_at": now,
+            "expires_at": datetime.fromtimestamp(now.timestamp() + idempotency_lock_seconds, timezone.utc),
+        })
+    except DuplicateKeyError:
+        existing = await db.idempotency_keys.find_one({"_id": record_id})
+        if existing is not None and expired(existing["expires_at"], now):
+            # The TTL monitor only sweeps about once a minute; drop lapsed claims ourselves
+            await db.idempotency_keys.delete_one({"_id": record_id, "expires_at": existing["expires_at"]})
+            existing = None
+        if existing is None:
+            # Expired before the lookup; treat as a fresh request
+            return await run_idempotent(scope, key, payload, handler)
+        if existing["request_hash"] != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        if existing["status"] != "completed":
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        return existing["response"]
+
+    try:
+        response = jsonable_encoder(await handler())
+    except Exception:
+        # Let the client retry with the same key
+        await db.idempotency_keys.delete_one({"_id": record_id})
+        raise
+
+    await db.idempotency_keys.update_one(
+        {"_id": record_id},
+        {"$set": {
+            "status": "completed",
+            "response": response,
+            "expires_at": datetime.fromtimestamp(now.timestamp() + idempotency_ttl_seconds, timezone.utc),
+        }},
+    )
+    return response
 
 # Basic routes
 @api_router.get("/")
 async def root():
     return {"message": "Welcome to Arovia Healthcare Platform"}
 
+@api_router.get("/health/live")
+async def health_live():
+    return {"status": "alive"}
+
+@api_router.get("/health/ready")
+async def health_ready():
+    if not app_ready:
+        return JSONResponse(status_code=503, content={"status": "warming_up"})
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), timeout=readiness_timeout_seconds)
+    except Exception:
+        logger.warning("Readiness check could not reach MongoDB", exc_info=True)
+        return JSONResponse(status_code=503, content={"status": "database_unavailable"})
+    return {"status": "ready"}
+
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate):
     status_dict = input.dict()
@@ -284,8 +489,7 @@ async def get_status_checks():
 # Doctor routes
 @api_router.get("/doctors", response_model=List[Doctor])
 async def get_doctors():
-    doctors = await db.doctors.find().to_list(1000)
-    return [Doctor(**doctor) for doctor in doctors]
+    return await get_catalog("doctors", Doctor)
 
 @api_router.get("/doctors/{doctor_id}", response_model=Doctor)
 async def get_doctor(doctor_id: str):
@@ -295,39 +499,44 @@ async def get_doctor(doctor_id: str):
     return Doctor(**doctor)
 
 @api_router.post("/doctors/book", response_model=DoctorBooking)
-async def book_doctor(booking: DoctorBooking):
-    booking_dict = booking.dict()
-    await db.doctor_bookings.insert_one(booking_dict)
-    return booking
+async def book_doctor(booking: DoctorBooking, idempotency_key: Optional[str] = Header(None)):
+    async def create_booking():
+        booking_dict = booking.dict()
+        await db.doctor_bookings.insert_one(booking_dict)
+        return booking
+
+    return await run_idempotent("doctors/book", idempotency_key, booking.dict(exclude_unset=True), create_booking)
 
 # Medicine routes
 @api_router.get("/medicines", response_model=List[Medicine])
 async def get_medicines():
-    medicines = await db.medicines.find().to_list(1000)
-    return [Medicine(**medicine) for medicine in medicines]
+    return await get_catalog("medicines", Medicine)
 
 @api_router.get("/medicines/category/{category}")
 async def get_medicines_by_category(category: str):
+    # Queried directly: the cached list is capped and may not hold every medicine in a category
     medicines = await db.medicines.find({"category": category}).to_list(1000)
     return [Medicine(**medicine) for medicine in medicines]
 
 # Emergency routes
 @api_router.get("/emergency/contacts", response_model=List[EmergencyContact])
 async def get_emergency_contacts():
-    contacts = await db.emergency_contacts.find().to_list(1000)
-    return [EmergencyContact(**contact) for contact in contacts]
+    return await get_catalog("emergency_contacts", EmergencyContact)
 
 @api_router.post("/emergency/sos")
-async def trigger_sos(location: dict):
-    # Log SOS trigger - in real app would send alerts
-    sos_log = {
-        "id": str(uuid.uuid4()),
-        "location": location,
-        "timestamp": datetime.now(timezone.utc),
-        "status": "triggered"
-    }
-    await db.sos_logs.insert_one(sos_log)
-    return {"message": "SOS triggered successfully", "sos_id": sos_log["id"]}
+async def trigger_sos(location: dict, idempotency_key: Optional[str] = Header(None)):
+    async def log_sos():
+        # Log SOS trigger - in real app would send alerts
+        sos_log = {
+            "id": str(uuid.uuid4()),
+            "location": location,
+            "timestamp": datetime.now(timezone.utc),
+            "status": "triggered"
+        }
+        await db.sos_logs.insert_one(sos_log)
+        return {"message": "SOS triggered successfully", "sos_id": sos_log["id"]}
+
+    return await run_idempotent("emergency/sos", idempotency_key, location, log_sos)
 
 # Dadi Chatbot route
 @api_router.post("/chat/dadi")
@@ -359,55 +568,422 @@ async def dadi_chat(user_message: dict):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Chat error: {str(e)}")
 
-# Health Planner route (Premium feature)
+# Health Planner (Premium feature)
+async def generate_health_plan(request: dict) -> dict:
+    user_data = request.get("user_data", {})
+    symptoms = user_data.get("symptoms", "")
+    age = user_data.get("age", "")
+    conditions = user_data.get("conditions", "")
+    
+    # Initialize health planner AI
+    chat = LlmChat(
+        api_key=emergent_llm_key,
+        session_id=f"health_plan_{request.get('user_id', 'anonymous')}",
+        system_message=f"""You are an AI health planner for rural Indian healthcare. Create personalized weekly health and diet plans.
+        Consider local availability of foods and medicines. Provide practical, affordable suggestions.
+        Focus on: diet recommendations, exercise suitable for rural areas, preventive care tips, and general wellness advice.
+        Keep suggestions simple and culturally appropriate for Indian rural families."""
+    ).with_model("openai", "gpt-4o-mini")
+    
+    prompt = f"""Create a weekly health plan for:
+    Age: {age}
+    Current symptoms/conditions: {symptoms or 'General wellness'}
+    Existing conditions: {conditions or 'None mentioned'}
+    
+    Please provide:
+    1. Diet recommendations (using locally available foods)
+    2. Simple exercises
+    3. Health tips
+    4. Medicine/supplement suggestions if needed
+    5. Warning signs to watch for
+    
+    Keep it practical for rural Indian families."""
+    
+    message = UserMessage(text=prompt)
+    response = await chat.send_message(message)
+    
+    # Save health plan
+    plan_record = ChatMessage(
+        user_id=request.get('user_id', 'anonymous'),
+        message=prompt,
+        response=response,
+        chat_type="health_plan"
+    )
+    await db.chat_messages.insert_one(plan_record.dict())
+    
+    return {"health_plan": response, "plan_id": plan_record.id}
+
+def planner_request_hash(request: dict) -> str:
+    # Identical submissions (same user and inputs) map to the same job
+    canonical = json.dumps(
+        {"user_id": request.get("user_id", "anonymous"), "user_data": request.get("user_data", {})},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+async def claim_planner_job() -> Optional[dict]:
+    now = datetime.now(timezone.utc)
+    return await db.planner_jobs.find_one_and_update(
+        {"$or": [
+            {"status": "queued"},
+            {"status": "running", "lease_until": {"$lt": now}},
+        ]},
+        {
+            "$set": {
+                "status": "running",
+                "lease_until": datetime.fromtimestamp(now.timestamp() + planner_lease_seconds, timezone.utc),
+                "updated_at": now,
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+async def run_planner_job(job: dict):
+    try:
+        # Give up before the lease lapses so no other worker generates the same plan concurrently
+        result = await asyncio.wait_for(generate_health_plan(job["request"]), timeout=planner_lease_seconds)
+        update = {"status": "completed", "result": result, "error": None}
+    except asyncio.TimeoutError:
+        logger.error("Health plan job %s timed out", job["id"])
+        update = {"status": "failed", "error": "Health plan generation timed out"}
+    except Exception as e:
+        logger.exception("Health plan job %s failed", job["id"])
+        update = {"status": "failed", "error": str(e)}
+    update["updated_at"] = datetime.now(timezone.utc)
+    update["lease_until"] = None
+    await db.planner_jobs.update_one({"id": job["id"]}, {"$set": update})
+
+async def planner_worker(worker_id: int):
+    while True:
+        try:
+            job = await claim_planner_job()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Planner worker %d could not claim a job", worker_id)
+            job = None
+        if job is None:
+            # Sleep until a new job is submitted or the poll interval elapses
+            planner_job_wakeup.clear()
+            try:
+                await asyncio.wait_for(planner_job_wakeup.wait(), timeout=planner_poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            await run_planner_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The job's lease will lapse and another claim will pick it up
+            logger.exception("Planner worker %d could not finish job %s", worker_id, job["id"])
+
+async def start_planner_workers():
+    await db.planner_jobs.create_index("id", unique=True)
+    await db.planner_jobs.create_index("request_hash", unique=True)
+    await db.planner_jobs.create_index([("status", 1), ("created_at", 1)])
+    for worker_id in range(planner_worker_count):
+        planner_workers.append(asyncio.create_task(planner_worker(worker_id)))
+
+async def stop_planner_workers():
+    for task in planner_workers:
+        task.cancel()
+    await asyncio.gather(*planner_workers, return_exceptions=True)
+    planner_workers.clear()
+
 @api_router.post("/health/planner")
 async def health_planner(request: dict):
     try:
-        user_data = request.get("user_data", {})
-        symptoms = user_data.get("symptoms", "")
-        age = user_data.get("age", "")
-        conditions = user_data.get("conditions", "")
-        
-        # Initialize health planner AI
-        chat = LlmChat(
-            api_key=emergent_llm_key,
-            session_id=f"health_plan_{request.get('user_id', 'anonymous')}",
-            system_message=f"""You are an AI health planner for rural Indian healthcare. Create personalized weekly health and diet plans.
-            Consider local availability of foods and medicines. Provide practical, affordable suggestions.
-            Focus on: diet recommendations, exercise suitable for rural areas, preventive care tips, and general wellness advice.
-            Keep suggestions simple and culturally appropriate for Indian rural families."""
-        ).with_model("openai", "gpt-4o-mini")
-        
-        prompt = f"""Create a weekly health plan for:
-        Age: {age}
-        Current symptoms/conditions: {symptoms or 'General wellness'}
-        Existing conditions: {conditions or 'None mentioned'}
-        
-        Please provide:
-        1. Diet recommendations (using locally available foods)
-        2. Simple exercises
-        3. Health tips
-        4. Medicine/supplement suggestions if needed
-        5. Warning signs to watch for
-        
-        Keep it practical for rural Indian families."""
-        
-        message = UserMessage(text=prompt)
-        response = await chat.send_message(message)
-        
-        # Save health plan
-        plan_record = ChatMessage(
-            user_id=request.get('user_id', 'anonymous'),
-            message=prompt,
-            response=response,
-            chat_type="health_plan"
-        )
-        await db.chat_messages.insert_one(plan_record.dict())
-        
-        return {"health_plan": response, "plan_id": plan_record.id}
+        return await generate_health_plan(request)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Health planner error: {str(e)}")
 
+@api_router.post("/health/planner/jobs", response_model=PlannerJob, status_code=202)
+async def submit_health_plan_job(request: dict):
+    job = PlannerJob(
+        request_hash=planner_request_hash(request),
+        user_id=request.get("user_id", "anonymous"),
+        request=request,
+    )
+    # Resubmitting the same request returns the existing job instead of queuing a new one
+    existing = await db.planner_jobs.find_one_and_update(
+        {"request_hash": job.request_hash},
+        {"$setOnInsert": job.dict()},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    if existing["status"] == "failed":
+        existing = await db.planner_jobs.find_one_and_update(
+            {"id": existing["id"], "status": "failed"},
+            {"$set": {"status": "queued", "error": None, "updated_at": datetime.now(timezone.utc)}},
+            return_document=ReturnDocument.AFTER,
+        ) or await db.planner_jobs.find_one({"id": existing["id"]})
+    if existing["status"] == "queued":
+        planner_job_wakeup.set()
+    return PlannerJob(**existing)
+
+@api_router.get("/health/planner/jobs/{job_id}", response_model=PlannerJob)
+async def get_health_plan_job(job_id: str):
+    job = await db.planner_jobs.find_one({"id": job_id})
+    if not job:
+        raise HTTPException(status_code=404, detail="Health plan job not found")
+    return PlannerJob(**job)
+
+# Symptom triage
+# Bump the version whenever rules change; it is returned with every analysis
+triage_knowledge_base = {
+    "version": "2026.10.2",
+    "rules": [
+        {
+            "id": "chest_pain",
+            "level": "emergency",
+            "phrases": [
+                "chest pain", "pain in chest", "pain in my chest", "heart attack", "chest tightness",
+                "seene mein dard", "seene me dard", "sine mein dard", "sine me dard",
+                "chhati mein dard", "chhati me dard", "chati me dard", "dil ka daura",
+            ],
+            "advice": "Chest pain can be a heart attack. Go to the nearest hospital now or call 108 for an ambulance. Do not walk or drive yourself; keep the person sitting and calm.",
+        },
+        {
+            "id": "unconscious",
+            "level": "emergency",
+            "phrases": [
+                "unconscious", "fainted", "not responding", "passed out", "unresponsive",
+                "behosh", "behoshi", "hosh nahi", "hosh nahin",
+            ],
+            "advice": "An unconscious person needs emergency care. Call 108 now. Lay them on their side, keep the airway clear and do not give anything by mouth.",
+        },
+        {
+            "id": "heavy_bleeding",
+            "level": "emergency",
+            "phrases": [
+                "heavy bleeding", "bleeding heavily", "lot of blood", "bleeding a lot", "blood vomiting", "vomiting blood",
+                "bahut khoon", "zyada khoon", "jyada khoon", "khoon beh raha", "khoon nahi ruk", "khoon ki ulti",
+            ],
+            "advice": "Heavy bleeding is an emergency. Press firmly on the wound with a clean cloth and go to the hospital now or call 108.",
+        },
+        {
+            "id": "breathing_difficulty",
+            "level": "emergency",
+            "phrases": [
+                "cannot breathe", "can't breathe", "difficulty breathing", "trouble breathing", "shortness of breath", "breathless",
+                "saans nahi", "saans lene mein taklif", "saans lene me taklif", "sans nahi", "saans phool", "sans phool",
+            ],
+            "advice": "Difficulty breathing needs urgent care. Sit the person upright, loosen tight clothing and go to the hospital now or call 108.",
+        },
+        {
+            "id": "heat_stroke",
+            "level": "emergency",
+            "phrases": ["heat stroke", "heatstroke", "sun stroke", "sunstroke", "loo lag", "lu lag"],
+            "advice": "Heat stroke is an emergency. Move the person to shade, remove extra clothing, cool them with wet cloths and fanning, give sips of water if awake, and call 108.",
+        },
+        {
+            "id": "stroke",
+            "level": "emergency",
+            "phrases": [
+                "stroke", "face drooping", "slurred speech", "one side weak", "paralysis",
+                "lakwa", "laqwa", "muh tedha", "munh tedha",
+            ],
+            "advice": "These are signs of a stroke. Every minute matters: go to the district hospital now or call 108.",
+        },
+        {
+            "id": "seizure",
+            "level": "emergency",
+            "phrases": ["seizure", "convulsion", "fits", "daura pad", "mirgi", "jhatke"],
+            "advice": "During a seizure, keep the person away from hard objects and turn them on their side. Do not put anything in the mouth. Call 108 if it lasts more than 5 minutes or is the first one.",
+        },
+        {
+            "id": "poisoning_or_bite",
+            "level": "emergency",
+            "phrases": [
+                "snake bite", "snakebite", "poison", "poisoning", "pesticide",
+                "saanp ne kata", "saap ne kata", "saanp kata", "zeher", "zehar", "jahar",
+            ],
+            "advice": "Poisoning or a snake bite needs hospital treatment now. Keep the person still, do not cut or suck the wound, and call 108.",
+        },
+        {
+            "id": "food_poisoning",
+            "level": "common",
+            "phrases": ["food poisoning", "bad food", "khana kharab", "kharab khana"],
+            "advice": "For food poisoning: drink ORS after every vomit or loose stool, take small sips if vomiting, and eat light food like khichdi once it settles. See a doctor if there is blood in vomit or stool, high fever, or no urine for 6 hours.",
+        },
+        {
+            "id": "fever",
+            "level": "common",
+            "phrases": ["fever", "temperature", "bukhar", "bukhaar"],
+            "advice": "For fever: rest, drink plenty of water and ORS, and take paracetamol as directed on the pack. See a doctor if the fever lasts more than 3 days, is very high, or comes with rash, confusion or breathing trouble.",
+        },
+        {
+            "id": "cold_cough",
+            "level": "common",
+            "phrases": [
+                "cold", "cough", "runny nose", "sneezing", "sore throat",
+                "khansi", "khaansi", "zukam", "jukam", "sardi", "gala kharab", "gale mein dard",
+            ],
+            "advice": "For cold and cough: drink warm water, take steam, gargle with warm salt water and try tulsi-ginger tea with honey (not for children under 1). See a doctor if it lasts over a week or breathing becomes difficult.",
+        },
+        {
+            "id": "headache",
+            "level": "common",
+            "phrases": ["headache", "head pain", "sir dard", "sar dard", "sir mein dard", "sar mein dard", "sir me dard"],
+            "advice": "For headache: rest in a quiet place, drink water and eat on time. Paracetamol can help. See a doctor if it is sudden and severe, follows an injury, or comes with vomiting or blurred vision.",
+        },
+        {
+            "id": "acidity",
+            "level": "common",
+            "phrases": ["acidity", "heartburn", "indigestion", "gas", "khatti dakar", "pet mein jalan", "pet me jalan"],
+            "advice": "For acidity: eat small meals, avoid spicy and oily food and do not lie down right after eating. Cold milk or saunf may help. See a doctor if there is vomiting, black stools or pain that spreads to the chest or arm.",
+        },
+        {
+            "id": "loose_motions",
+            "level": "common",
+            "phrases": ["diarrhea", "diarrhoea", "loose motion", "loose motions", "dast", "pet kharab", "patla paikhana"],
+            "advice": "For loose motions: drink ORS after every stool, continue light food like khichdi and curd, and wash hands well. See a doctor quickly if there is blood in the stool, no urine for 6 hours, or a child becomes drowsy.",
+        },
+    ],
+    # Any of these means a common complaint needs the LLM (which also sees age) rather than canned advice
+    "red_flag_modifiers": [
+        r"blood\w*", r"bleed\w*", r"khoon", r"khun",
+        r"bab(?:y|ies)", r"infants?", r"newborns?", r"bach+[ae]", r"bachch?(?:a|i|e)", r"shishu", r"month\s+old",
+        r"\d+", r"days?", r"weeks?", r"months?", r"din", r"hafte?", r"mahin[ae]",
+        r"severe\w*", r"very", r"high", r"extreme\w*", r"unbearable", r"tez", r"bahut", r"zyada", r"jyada",
+        r"injur\w*", r"accident", r"fell", r"fall\w*", r"chot", r"ghav",
+        r"pregnan\w*", r"garbh\w*",
+    ],
+    # Words allowed alongside a matched phrase for a clause to be answered locally
+    "filler_words": [
+        "i", "im", "i'm", "have", "has", "having", "got", "a", "an", "the", "my", "me", "is", "am", "feel",
+        "feeling", "mild", "slight", "little", "bit", "of", "some", "just", "only", "also", "today", "since",
+        "morning", "mujhe", "mera", "meri", "mere", "ko", "hai", "hain", "ho", "raha", "rahi", "rahe", "hua",
+        "hui", "thoda", "thodi", "halka", "halki", "bhi", "sirf", "bas", "aaj", "se",
+        "no", "not", "nahi", "nahin", "na",
+    ],
+    "negation_before": ["no", "not", "without", "never", "denies", "koi", "bina"],
+    "negation_after": ["nahi", "nahin", "na", "nai"],
+    "min_local_age": 5,
+    "max_local_age": 59,
+}
+
+emergency_contacts_path = "/api/emergency/contacts"
+triage_counters = {"emergency": 0, "local": 0, "llm": 0}
+
+def compile_triage_matcher(knowledge_base: dict):
+    phrase_rules = {}
+    for rule in knowledge_base["rules"]:
+        for phrase in rule["phrases"]:
+            phrase_rules[" ".join(phrase.lower().split())] = rule
+    # Longest phrases first so "chest pain" wins over any shorter overlapping phrase
+    alternatives = sorted(phrase_rules, key=len, reverse=True)
+    pattern = re.compile(r"\b(?:" + "|".join(re.escape(p).replace(r"\ ", r"\s+") for p in alternatives) + r")\b")
+    return pattern, phrase_rules
+
+triage_pattern, triage_phrase_rules = compile_triage_matcher(triage_knowledge_base)
+triage_modifier_pattern = re.compile(r"\b(?:" + "|".join(triage_knowledge_base["red_flag_modifiers"]) + r")\b")
+triage_filler_words = frozenset(triage_knowledge_base["filler_words"])
+triage_negation_before = frozenset(triage_knowledge_base["negation_before"])
+triage_negation_after = frozenset(triage_knowledge_base["negation_after"])
+triage_clause_separators = re.compile(r"[,;.\n]|\b(?:and|aur|with|or|but|lekin|par)\b")
+triage_word_pattern = re.compile(r"[a-z']+|\d+")
+
+def is_negated(clause: str, match) -> bool:
+    before = clause[:match.start()].split()[-3:]
+    after = clause[match.end():].split()[:2]
+    return bool(triage_negation_before.intersection(before) or triage_negation_after.intersection(after))
+
+triage_age_pattern = re.compile(
+    r"^\s*(\d+(?:\.\d+)?)\s*"
+    r"(years?|yrs?|y|saal|sal|varsh|months?|mos?|mahine?|weeks?|wks?|hafte?|days?|din)?"
+    r"\s*(?:old)?\s*$"
+)
+triage_age_units = {"month": 12, "mo": 12, "mahin": 12, "week": 52, "wk": 52, "haft": 52, "day": 365, "din": 365}
+
+def parse_age(age: Any) -> Optional[float]:
+    """Age in years from inputs like "30", "30 years", "6 months" or "1.5 yrs"; None if unreadable."""
+    match = triage_age_pattern.match(str(age if age is not None else "").lower())
+    if not match:
+        return None
+    unit = match.group(2) or ""
+    divisor = next((value for prefix, value in triage_age_units.items() if unit.startswith(prefix)), 1)
+    return float(match.group(1)) / divisor
+
+def triage_symptoms(symptoms: str, age: Any = None) -> Optional[dict]:
+    """Match symptoms against the local knowledge base.
+
+    Returns the matched rules when the complaint can be answered without the
+    LLM: any (non-negated) red flag, or a patient whose age parses within
+    min_local_age..max_local_age and whose every clause is a known common
+    condition plus filler words.
+    """
+    clauses = [clause for clause in triage_clause_separators.split(symptoms.lower()) if clause.strip()]
+    matched = []
+    for clause in clauses:
+        for match in triage_pattern.finditer(clause):
+            if is_negated(clause, match):
+                continue
+            rule = triage_phrase_rules[" ".join(match.group(0).split())]
+            if rule not in matched:
+                matched.append(rule)
+    if not matched:
+        return None
+
+    emergencies = [rule for rule in matched if rule["level"] == "emergency"]
+    if emergencies:
+        return {"level": "emergency", "rules": emergencies}
+
+    if triage_modifier_pattern.search(symptoms.lower()):
+        return None
+    # Canned advice is only safe for a known working-age patient; anyone else goes to the LLM
+    patient_age = parse_age(age)
+    if patient_age is None or not (
+        triage_knowledge_base["min_local_age"] <= patient_age <= triage_knowledge_base["max_local_age"]
+    ):
+        return None
+    for clause in clauses:
+        leftover = triage_word_pattern.findall(triage_pattern.sub(" ", clause))
+        if not triage_filler_words.issuperset(leftover):
+            return None
+    return {"level": "common", "rules": matched}
+
+async def save_triage_answer(request: dict, triage: dict) -> dict:
+    source = "emergency" if triage["level"] == "emergency" else "local"
+    triage_counters[source] += 1
+    advice = "\n\n".join(rule["advice"] for rule in triage["rules"])
+    if source == "emergency":
+        analysis = f"EMERGENCY: {advice}\n\nNearby hospitals and ambulance numbers are listed under Emergency Contacts."
+    else:
+        analysis = f"{advice}\n\nThis is general guidance only. Please consult a qualified doctor for proper diagnosis and treatment."
+
+    analysis_record = ChatMessage(
+        user_id=request.get('user_id', 'anonymous'),
+        message=request.get("symptoms", ""),
+        response=analysis,
+        chat_type="symptom_analysis"
+    )
+    await db.chat_messages.insert_one(analysis_record.dict())
+
+    return {
+        "analysis": analysis,
+        "analysis_id": analysis_record.id,
+        "triage": {
+            "source": source,
+            "matched": [rule["id"] for rule in triage["rules"]],
+            "kb_version": triage_knowledge_base["version"],
+            "emergency_contacts": emergency_contacts_path if source == "emergency" else None,
+        },
+    }
+
+@api_router.get("/symptoms/triage/stats")
+async def get_triage_stats():
+    total = sum(triage_counters.values())
+    return {
+        "kb_version": triage_knowledge_base["version"],
+        "counts": dict(triage_counters),
+        "local_ratio": (total - triage_counters["llm"]) / total if total else 0.0,
+    }
+
 # Symptom Analysis route
 @api_router.post("/symptoms/analyze")
 async def analyze_symptoms(request: dict):
@@ -415,6 +991,11 @@ async def analyze_symptoms(request: dict):
         symptoms = request.get("symptoms", "")
         age = request.get("age", "")
         
+        # Red flags and simple common complaints are answered locally without the LLM
+        triage = triage_symptoms(symptoms, age)
+        if triage is not None:
+            return await save_triage_answer(request, triage)
+        
         chat = LlmChat(
             api_key=emergent_llm_key,
             session_id=f"symptom_analysis_{request.get('user_id', 'anonymous')}",
@@ -438,6 +1019,7 @@ async def analyze_symptoms(request: dict):
         
         message = UserMessage(text=prompt)
         response = await chat.send_message(message)
+        triage_counters["llm"] += 1
         
         # Save analysis
         analysis_record = ChatMessage(
@@ -448,7 +1030,16 @@ async def analyze_symptoms(request: dict):
         )
         await db.chat_messages.insert_one(analysis_record.dict())
         
-        return {"analysis": response, "analysis_id": analysis_record.id}
+        return {
+            "analysis": response,
+            "analysis_id": analysis_record.id,
+            "triage": {
+                "source": "llm",
+                "matched": [],
+                "kb_version": triage_knowledge_base["version"],
+                "emergency_contacts": None,
+            },
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Symptom analysis error: {str(e)}")
 
@@ -459,33 +1050,36 @@ async def get_disease_alerts():
     return [DiseaseAlert(**alert) for alert in alerts]
 
 @api_router.post("/disease/report")
-async def report_disease(report: dict):
-    # In real app, this would analyze patterns and create alerts
-    village = report.get("village", "")
-    disease = report.get("disease", "")
+async def report_disease(report: dict, idempotency_key: Optional[str] = Header(None)):
+    async def record_report():
+        # In real app, this would analyze patterns and create alerts
+        village = report.get("village", "")
+        disease = report.get("disease", "")
     
-    # Check if alert exists for this village+disease combo
-    existing = await db.disease_alerts.find_one({"village": village, "disease": disease})
+        # Check if alert exists for this village+disease combo
+        existing = await db.disease_alerts.find_one({"village": village, "disease": disease})
     
-    if existing:
-        # Increment case count
-        await db.disease_alerts.update_one(
-            {"village": village, "disease": disease},
-            {"$inc": {"cases_reported": 1}}
-        )
-    else:
-        # Create new alert
-        alert = DiseaseAlert(
-            village=village,
-            disease=disease,
-            cases_reported=1,
-            alert_level="low",
-            description=f"New cases of {disease} reported in {village}",
-            prevention_tips="Maintain hygiene, drink clean water, seek medical advice if symptoms persist"
-        )
-        await db.disease_alerts.insert_one(alert.dict())
+        if existing:
+            # Increment case count
+            await db.disease_alerts.update_one(
+                {"village": village, "disease": disease},
+                {"$inc": {"cases_reported": 1}}
+            )
+        else:
+            # Create new alert
+            alert = DiseaseAlert(
+                village=village,
+                disease=disease,
+                cases_reported=1,
+                alert_level="low",
+                description=f"New cases of {disease} reported in {village}",
+                prevention_tips="Maintain hygiene, drink clean water, seek medical advice if symptoms persist"
+            )
+            await db.disease_alerts.insert_one(alert.dict())
     
-    return {"message": "Disease report recorded"}
+        return {"message": "Disease report recorded"}
+
+    return await run_idempotent("disease/report", idempotency_key, report, record_report)
 
 # Reminders routes
 @api_router.get("/reminders/{user_id}", response_model=List[HealthReminder])
@@ -494,14 +1088,384 @@ async def get_user_reminders(user_id: str):
     return [HealthReminder(**reminder) for reminder in reminders]
 
 @api_router.post("/reminders", response_model=HealthReminder)
-async def create_reminder(reminder: HealthReminder):
-    reminder_dict = reminder.dict()
-    await db.health_reminders.insert_one(reminder_dict)
-    return reminder
+async def create_reminder(reminder: HealthReminder, idempotency_key: Optional[str] = Header(None)):
+    async def save_reminder():
+        reminder_dict = reminder.dict()
+        await db.health_reminders.insert_one(reminder_dict)
+        return reminder
+
+    return await run_idempotent("reminders", idempotency_key, reminder.dict(exclude_unset=True), save_reminder)
+
+# Admin bulk import/export routes
+export_fields = {
+    "doctor_bookings": list(DoctorBooking.model_fields),
+    "disease_alerts": list(DiseaseAlert.model_fields),
+    "sos_logs": ["id", "location", "timestamp", "status"],
+}
+import_models = {
+    "doctors": Doctor,
+    "medicines": Medicine,
+}
+
+def require_admin(admin_key: Optional[str]):
+    if not admin_api_key or not hmac.compare_digest((admin_key or "").encode(), admin_api_key.encode()):
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+def export_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=export_value)
+    return value
+
+async def export_rows(collection: str, fmt: str) -> AsyncIterator[str]:
+    fields = export_fields[collection]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(fields)
+    rows = 0
+    cursor = db[collection].find({}, {"_id": 0}, batch_size=bulk_batch_size)
+    async for doc in cursor:
+        if fmt == "csv":
+            writer.writerow([export_value(doc.get(field)) for field in fields])
+        else:
+            buffer.write(json.dumps(doc, default=export_value))
+            buffer.write("\n")
+        rows += 1
+        if rows % bulk_batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+async def upload_lines(request: Request) -> AsyncIterator[List[str]]:
+    """Yield the complete lines of a streamed upload, one network chunk at a time."""
+    # utf-8-sig drops the BOM that Excel's "CSV UTF-8" export puts before the header
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in request.stream():
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        if lines:
+            yield lines
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield [pending]
+
+async def upload_records(request: Request, fmt: str) -> AsyncIterator[List[Tuple[int, Any]]]:
+    """Yield (row number, raw row) batches parsed incrementally from an upload."""
+    row_number = 0
+    header = None
+    record = ""
+    async for lines in upload_lines(request):
+        batch = []
+        if fmt == "ndjson":
+            for line in lines:
+                if line.strip():
+                    row_number += 1
+                    batch.append((row_number, line))
+            yield batch
+            continue
+
+        # CSV fields may contain quoted newlines; a record ends when its quotes balance
+        records = []
+        for line in lines:
+            record = f"{record}\n{line}" if record else line
+            if record.count('"') % 2 == 0:
+                if record.strip():
+                    records.append(record)
+                record = ""
+        for values in csv.reader(records):
+            if header is None:
+                header = [name.strip() for name in values]
+                continue
+            row_number += 1
+            batch.append((row_number, dict(zip(header, values))))
+        yield batch
+
+def parse_import_row(model, raw: Any) -> Dict[str, Any]:
+    if isinstance(raw, str):
+        raw = json.loads(raw)
+    if not isinstance(raw, dict):
+        raise ValueError("Row must be an object")
+    # Rows are upserted by id, so re-importing a file must not mint fresh ids
+    if not str(raw.get("id") or "").strip():
+        raise ValueError("Row is missing an id")
+    # Empty CSV cells mean "not provided" so optional fields and defaults apply
+    return model(**{key: value for key, value in raw.items() if value != ""}).dict()
+
+@api_router.get("/admin/export/{collection}")
+async def export_collection(
+    collection: str,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    x_admin_key: Optional[str] = Header(None),
+):
+    require_admin(x_admin_key)
+    if collection not in export_fields:
+        raise HTTPException(status_code=404, detail="Unknown export collection")
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        export_rows(collection, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{collection}.{format}"'},
+    )
+
+@api_router.post("/admin/import/{catalog}")
+async def import_catalog(
+    catalog: str,
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+    x_admin_key: Optional[str] = Header(None),
+):
+    require_admin(x_admin_key)
+    model = import_models.get(catalog)
+    if model is None:
+        raise HTTPException(status_code=404, detail="Unknown import catalog")
+    if format is None:
+        format = "csv" if "csv" in request.headers.get("content-type", "") else "ndjson"
+    await db[catalog].create_index("id", unique=True)
+
+    imported = 0
+    failed = 0
+    errors = []
+
+    def record_error(row: Any, error: str):
+        nonlocal failed
+        failed += 1
+        if len(errors) < bulk_max_reported_errors:
+            errors.append({"row": row, "error": error})
+
+    async def write_batch(operations: List[ReplaceOne], rows: List[int]):
+        nonlocal imported
+        try:
+            result = await db[catalog].bulk_write(operations, ordered=False)
+            imported += result.upserted_count + result.matched_count
+        except BulkWriteError as e:
+            imported += e.details.get("nUpserted", 0) + e.details.get("nMatched", 0)
+            for write_error in e.details.get("writeErrors", []):
+                record_error(rows[write_error["index"]], write_error["errmsg"])
+
+    # Keep one bulk_write in flight while the next batch is being parsed
+    in_flight = None
+    operations, rows = [], []
+    async for batch in upload_records(request, format):
+        for row_number, raw in batch:
+            try:
+                doc = parse_import_row(model, raw)
+            except Exception as e:
+                record_error(row_number, str(e))
+                continue
+            operations.append(ReplaceOne({"id": doc["id"]}, doc, upsert=True))
+            rows.append(row_number)
+            if len(operations) >= bulk_batch_size:
+                if in_flight:
+                    await in_flight
+                in_flight = asyncio.create_task(write_batch(operations, rows))
+                operations, rows = [], []
+    if in_flight:
+        await in_flight
+    if operations:
+        await write_batch(operations, rows)
+    catalog_cache.pop(catalog, None)
+
+    return {"imported": imported, "failed": failed, "errors": errors}
+
+# Rate limiting
+def parse_rate_limits(spec: str) -> Dict[Tuple[str, str], Tuple[float, float]]:
+    limits = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        route, _, limit = entry.rpartition('=')
+        method, _, path = route.strip().rpartition(' ')
+        capacity, _, seconds = limit.partition('/')
+        limits[(method.upper() or "POST", path)] = (float(capacity), float(capacity) / float(seconds))
+    return limits
+
+class RateLimitMiddleware:
+    """Token-bucket limiter keyed by route and caller.
+
+    Every caller is limited per client IP, and additionally per user_id when
+    the request body carries one, so rotating user_ids does not escape the
+    limit. The client IP is the socket peer, unless the peer is one of
+    RATE_LIMIT_TRUSTED_PROXIES; then it is the right-most X-Forwarded-For
+    address that is not itself a trusted proxy. Behind an ingress without
+    that setting every user shares the ingress IP, so either configure it or
+    set RATE_LIMIT_IP_MULTIPLIER=0 to drop the IP bucket for requests that
+    carry a user_id. Buckets live in process memory by default; with
+    RATE_LIMIT_BACKEND=mongo they are kept in the rate_limits collection so
+    all workers share them.
+    """
+
+    max_memory_buckets = 10000
+
+    def __init__(
+        self,
+        app,
+        limits: Dict[Tuple[str, str], Tuple[float, float]],
+        backend: str = "memory",
+        ip_multiplier: float = 5,
+        trusted_proxies: Optional[List[Any]] = None,
+    ):
+        self.app = app
+        self.limits = limits
+        self.backend = backend
+        self.ip_multiplier = ip_multiplier
+        self.trusted_proxies = trusted_proxies or []
+        # Least recently used first, so eviction is O(1) once the cap is reached
+        self.buckets: "OrderedDict[Tuple[str, str, str], Tuple[float, float]]" = OrderedDict()
+        self.mongo_ready = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route = (scope["method"], scope["path"].rstrip("/"))
+        limit = self.limits.get(route)
+        if limit is None:
+            return await self.app(scope, receive, send)
+
+        receive, user_id = await self.peek_user_id(receive)
+        client_ip = self.client_ip(scope)
+        capacity, rate = limit
+        if not user_id:
+            buckets = [(f"ip:{client_ip}", capacity, rate)]
+        elif self.ip_multiplier > 0:
+            buckets = [
+                (f"ip:{client_ip}", capacity * self.ip_multiplier, rate * self.ip_multiplier),
+                (user_id, capacity, rate),
+            ]
+        else:
+            buckets = [(user_id, capacity, rate)]
+
+        headers = []
+        lowest_fraction = None
+        for caller, bucket_capacity, bucket_rate in buckets:
+            allowed, tokens = await self.take(route, caller, bucket_capacity, bucket_rate)
+            bucket_headers = [
+                (b"x-ratelimit-limit", str(int(bucket_capacity)).encode()),
+                (b"x-ratelimit-remaining", str(int(tokens)).encode()),
+                (b"x-ratelimit-reset", str(math.ceil((bucket_capacity - tokens) / bucket_rate)).encode()),
+            ]
+            if not allowed:
+                retry_after = str(math.ceil((1 - tokens) / bucket_rate)).encode()
+                response = JSONResponse(status_code=429, content={"detail": "Rate limit exceeded"})
+                response.raw_headers.extend(bucket_headers + [(b"retry-after", retry_after)])
+                return await response(scope, receive, send)
+            # Report whichever bucket is closest to running out
+            if lowest_fraction is None or tokens / bucket_capacity < lowest_fraction:
+                lowest_fraction = tokens / bucket_capacity
+                headers = bucket_headers
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+    def is_trusted_proxy(self, address: str) -> bool:
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(ip in network for network in self.trusted_proxies)
+
+    def client_ip(self, scope) -> str:
+        client = scope.get("client")
+        address = client[0] if client else "unknown"
+        if not self.is_trusted_proxy(address):
+            return address
+        forwarded = []
+        for name, value in scope.get("headers", []):
+            if name == b"x-forwarded-for":
+                forwarded.extend(part.strip() for part in value.decode("latin-1").split(","))
+        # Walk back from the nearest hop; entries left of the first untrusted one are client-controlled
+        for hop in reversed(forwarded):
+            if hop and not self.is_trusted_proxy(hop):
+                return hop
+        return address
+
+    async def take(self, route, caller, capacity, rate) -> Tuple[bool, float]:
+        if self.backend == "mongo":
+            try:
+                return await self.take_mongo(route, caller, capacity, rate)
+            except Exception:
+                # Keep serving with per-worker limits rather than failing every limited route
+                logger.warning("Shared rate limit store unavailable, using in-memory buckets", exc_info=True)
+        return self.take_memory(route, caller, capacity, rate)
+
+    async def peek_user_id(self, receive):
+        # Buffer the (small JSON) body so the route can still read it afterwards
+        messages = []
+        while True:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request" or not message.get("more_body", False):
+                break
+
+        async def replay():
+            if messages:
+                return messages.pop(0)
+            return await receive()
+
+        body = b"".join(m.get("body", b"") for m in messages if m["type"] == "http.request")
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            payload = {}
+        user_id = payload.get("user_id") if isinstance(payload, dict) else None
+        return replay, (f"user:{user_id}" if user_id else None)
+
+    def take_memory(self, route, user_id, capacity, rate) -> Tuple[bool, float]:
+        now = time.monotonic()
+        key = (route[0], route[1], user_id)
+        tokens, updated = self.buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_memory_buckets:
+            self.buckets.popitem(last=False)
+        return allowed, tokens
+
+    async def take_mongo(self, route, user_id, capacity, rate) -> Tuple[bool, float]:
+        if not self.mongo_ready:
+            await db.rate_limits.create_index("expires_at", expireAfterSeconds=0)
+            self.mongo_ready = True
+        now = datetime.now(timezone.utc)
+        elapsed_seconds = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}
+        bucket = await db.rate_limits.find_one_and_update(
+            {"_id": f"{route[0]} {route[1]}|{user_id}"},
+            [
+                {"$set": {
+                    "tokens": {"$min": [capacity, {"$add": [
+                        {"$ifNull": ["$tokens", capacity]},
+                        {"$multiply": [elapsed_seconds, rate]},
+                    ]}]},
+                    "updated_at": now,
+                    "expires_at": datetime.fromtimestamp(now.timestamp() + capacity / rate, timezone.utc),
+                }},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return bucket["allowed"], bucket["tokens"]
 
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(
+    RateLimitMiddleware,
+    limits=parse_rate_limits(os.environ.get('RATE_LIMITS', default_rate_limits)),
+    backend=rate_limit_backend,
+    ip_multiplier=rate_limit_ip_multiplier,
+    trusted_proxies=rate_limit_trusted_proxies,
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -515,8 +1479,4 @@ logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
-logger = logging.getLogger(__name__)
-
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+logger = logging.getLogger(__name__)
\ No newline at end of file